@@ -1,31 +1,60 @@
 #!/usr/bin/env python3
 # scripts/generate_answers.py
 # Minimal, robust generator for testing (N=10 default).
-# Uses OPENAI_API_KEY (fallback from GROQ_API if present).
+# Calls the Groq chat-completions API; key from GROQ_API / GROQ_API_KEY.
 
 import os
 import json
 import time
 import random
+import asyncio
+import hashlib
+import argparse
+import sqlite3
+import logging
 from pathlib import Path
 
-# --- env fallback (Codespaces) ---
-if os.getenv("GROQ_API") and not os.getenv("OPENAI_API_KEY"):
-    os.environ["OPENAI_API_KEY"] = os.getenv("GROQ_API")
-
+import httpx
+import orjson
 import pandas as pd
+from aiolimiter import AsyncLimiter
 from tqdm import tqdm
+from tqdm.contrib.logging import logging_redirect_tqdm
+
+# per-rij details alleen met --verbose; standaard toont alleen de tqdm-balk voortgang
+log = logging.getLogger("generate_answers")
+log.addHandler(logging.NullHandler())
 
-# Note: we will use the new openai client when calling the LLM inside call_llm
-# openai.api_key is kept for backward compat if needed by other libs
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-MODEL = os.getenv("OPENAI_MODEL", "gpt-4o")  # adjust if necessary
+# --- Env (één keer uitgelezen) ---
+API_KEY = os.getenv("GROQ_API") or os.getenv("GROQ_API_KEY")
+MODEL = os.getenv("MODEL")  # expliciet model; None = FALLBACK_MODELS proberen
 
 # --- Parameters (test) ---
 N = 10  # test-run; zet op 1000 voor full-run
 CSV_PATH = Path("data/volker_nexus_group_populatie_2000_clean.csv")
 OUT_PATH = Path("results/generated_answers.jsonl")
+CACHE_PATH = Path("results/.llm_cache.sqlite")
+CACHE_TTL = 7 * 24 * 3600  # seconden; oudere antwoorden worden opnieuw opgevraagd
 SEED = 42
+GROQ_BASE_URL = "https://api.groq.com/openai/v1"
+GROQ_URL = f"{GROQ_BASE_URL}/chat/completions"
+BATCH_INPUT_PATH = Path("results/batchinput.jsonl")
+BATCH_MODEL = "llama-3.1-8b-instant"  # model voor --batch als MODEL niet gezet is
+BATCH_POLL_INTERVAL = 30  # seconden
+FLUSH_EVERY = 32  # records tussen twee flushes van het outputbestand
+CONCURRENCY = 8  # max gelijktijdige requests
+QPM = 30  # max requests per minuut (rate limit provider)
+FALLBACK_MODELS = [
+    "groq/compound",
+    "groq/compound-mini",
+    "llama-3.1-8b-instant",
+    "llama-3.3-70b-versatile",
+    "openai/gpt-oss-20b",
+]
+BAD_MODELS: set[str] = set()  # modellen die 404 (onbekend model) gaven; overslaan rest van de run
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+MAX_RETRIES = 5
+MAX_RETRY_DELAY = 30  # seconden
 USER_QUESTION = (
     "Wat moet Volker Nexus Group doen om AI verantwoord en snel te integreren in "
     "werkvoorbereiding en uitvoering? Geef (A) één korte principiële aanbeveling, "
@@ -33,21 +62,13 @@ USER_QUESTION = (
     "en (C) één risico/bezwaar dat deze persoon waarschijnlijk voelt."
 )
 
-PROMPT_TEMPLATE = """
+# Statisch deel staat vooraan en is bij elke call byte-identiek, zodat de
+# provider de prefix kan cachen; alleen het korte medewerkerblok (build_prompts)
+# varieert.
+STATIC_PREFIX = f"""Je bent een beknopte, praktische adviseur. Antwoord in het Nederlands.
 Je bent een collega-adviseur bij Volker Nexus Group (bouw/infra).
-Hieronder staan kenmerken van één medewerker. Schrijf in maximaal ~120-200 woorden een korte, op deze persoon toegespitste reactie op de vraag:
-Vraag: {question}
-
-Medewerker (kort):
-- Functie: {functie}
-- Afdeling: {afdeling}
-- Team: {team}
-- Studie: {studie_niveau} ({opleidingsrichting})
-- Specialisatie: {specialisatie}
-- Werkervaring (jaren): {werkervaring_jaren}
-- Senioriteit: {senioriteit}
-- AI-affiniteit: {ai_affiniteit}
-- % werk op computer: {pct_pc}
+Je krijgt kenmerken van één medewerker. Schrijf in maximaal ~120-200 woorden een korte, op deze persoon toegespitste reactie op de vraag:
+Vraag: {USER_QUESTION}
 
 Antwoordformaat (verplicht):
 A) Eén korte principiële aanbeveling (1 zin).
@@ -55,136 +76,559 @@ B) Twee concrete acties (elk 1 regel) die deze persoon kan ondersteunen of voors
 C) Eén risico/bezwaar dat deze persoon waarschijnlijk voelt (1 zin).
 Wees bondig, praktisch, Nederlands, max 200 woorden totaal.
 """
+SYSTEM_MESSAGE = {"role": "system", "content": STATIC_PREFIX}
+
+# ~200 woorden Nederlands ≈ 300 tokens; stop zodra het model na C) doorgaat.
+MAX_TOKENS = 300
+STOP_SEQUENCES = ["\n\nD)"]
+MAX_FIELD_LEN = 80  # tekens per medewerkerveld in de prompt
+
+# Alleen deze kolommen worden gebruikt; de CSV heeft er ~70.
+USE_COLS = [
+    "medewerker_id", "functie", "afdeling", "team", "studie_niveau",
+    "opleidingsrichting", "opleiding", "specialisatie", "werkervaring_jaren",
+    "senioriteit", "ai_affiniteit", "%_werk_op_computer", "pct_pc",
+]
+# numerieke kolommen als tekst inlezen; load_data zet ze om met errors="coerce",
+# zodat een cel als "onbekend" of "4.5" niet de hele load laat falen
+DTYPES = {"werkervaring_jaren": str, "%_werk_op_computer": str, "pct_pc": str}
+# tekstkolommen voor de prompt en hun waarde bij NaN / ontbrekende kolom
+STR_DEFAULTS = {
+    "medewerker_id": "", "functie": "", "afdeling": "", "team": "", "studie_niveau": "",
+    "specialisatie": "", "senioriteit": "", "ai_affiniteit": "Gemiddeld",
+}
 
 random.seed(SEED)
 
 def load_data(path: Path):
     if not path.exists():
         raise FileNotFoundError(f"CSV niet gevonden: {path}")
-    df = pd.read_csv(path)
+    df = pd.read_csv(path, usecols=lambda c: c in USE_COLS, dtype=DTYPES)
+
+    # Eén keer normaliseren (NaN, ontbrekende kolommen, types), zodat
+    # build_prompts alleen nog hoeft te formatteren.
+    for col, default in STR_DEFAULTS.items():
+        df[col] = df[col].fillna(default).astype(str) if col in df.columns else default
+    opleiding = df["opleiding"].fillna("").astype(str) if "opleiding" in df.columns else ""
+    if "opleidingsrichting" in df.columns:
+        df["opleidingsrichting"] = df["opleidingsrichting"].fillna(opleiding).astype(str)
+    else:
+        df["opleidingsrichting"] = opleiding
+    if "werkervaring_jaren" in df.columns:
+        df["werkervaring_jaren"] = pd.to_numeric(df["werkervaring_jaren"], errors="coerce").fillna(0).astype("int32")
+    else:
+        df["werkervaring_jaren"] = 0
+    pct = df["%_werk_op_computer"] if "%_werk_op_computer" in df.columns else df.get("pct_pc")
+    if pct is not None:
+        df["pct_pc"] = pd.to_numeric(pct, errors="coerce").fillna(50).astype("int16")
+    else:
+        df["pct_pc"] = 50
     return df
 
-def build_prompt(row):
-    return PROMPT_TEMPLATE.format(
-        question=USER_QUESTION,
-        functie=row.get("functie", ""),
-        afdeling=row.get("afdeling", ""),
-        team=row.get("team", ""),
-        studie_niveau=row.get("studie_niveau", ""),
-        opleidingsrichting=row.get("opleidingsrichting", row.get("opleiding","")),
-        specialisatie=row.get("specialisatie", ""),
-        werkervaring_jaren=int(row.get("werkervaring_jaren", 0) or 0),
-        senioriteit=row.get("senioriteit", ""),
-        ai_affiniteit=row.get("ai_affiniteit", "Gemiddeld"),
-        pct_pc=row.get("%_werk_op_computer", row.get("pct_pc", 50)),
+def _trunc(s: pd.Series, n: int = MAX_FIELD_LEN) -> pd.Series:
+    """Clamps every string in s to n characters (vectorized)."""
+    return s.where(s.str.len() <= n, s.str.slice(0, n) + "…")
+
+def build_prompts(df: pd.DataFrame) -> pd.Series:
+    """
+    Builds the per-employee user message for every row in one vectorized pass
+    (string concatenation on whole columns instead of str.format per row).
+    Expects a frame normalized by load_data.
+    """
+    return (
+        "Medewerker (kort):\n"
+        + "- Functie: " + _trunc(df["functie"]) + "\n"
+        + "- Afdeling: " + _trunc(df["afdeling"]) + "\n"
+        + "- Team: " + _trunc(df["team"]) + "\n"
+        + "- Studie: " + _trunc(df["studie_niveau"]) + " (" + _trunc(df["opleidingsrichting"]) + ")\n"
+        + "- Specialisatie: " + _trunc(df["specialisatie"]) + "\n"
+        + "- Werkervaring (jaren): " + df["werkervaring_jaren"].astype(str) + "\n"
+        + "- Senioriteit: " + _trunc(df["senioriteit"]) + "\n"
+        + "- AI-affiniteit: " + _trunc(df["ai_affiniteit"]) + "\n"
+        + "- % werk op computer: " + df["pct_pc"].astype(str) + "\n"
     )
 
-def call_llm(prompt: str):
+class ResponseCache:
+    """
+    Exact-match response cache on disk (SQLite).
+    Key = sha256 of the request payload (model, messages, temperature, max_tokens),
+    so a hit means the identical request was answered before.
+    """
+
+    def __init__(self, path: Path, ttl: float = CACHE_TTL):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses "
+            "(key TEXT PRIMARY KEY, text TEXT NOT NULL, created REAL NOT NULL)"
+        )
+
+    @staticmethod
+    def key(payload: dict) -> str:
+        blob = json.dumps(payload, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+    def get(self, payload: dict):
+        row = self.conn.execute(
+            "SELECT text, created FROM responses WHERE key = ?", (self.key(payload),)
+        ).fetchone()
+        # lege antwoorden tellen als miss (kunnen uit een oudere cache stammen)
+        if row is None or not row[0] or time.time() - row[1] > self.ttl:
+            return None
+        return row[0]
+
+    def set(self, payload: dict, text: str):
+        if not text:
+            return  # nooit een leeg antwoord vastleggen
+        self.conn.execute(
+            "INSERT OR REPLACE INTO responses (key, text, created) VALUES (?, ?, ?)",
+            (self.key(payload), text, time.time()),
+        )
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+def make_client(key: str) -> httpx.AsyncClient:
+    """
+    One pooled client for the whole run: keep-alive reuses TCP+TLS connections
+    across rows and the auth headers are built once instead of per request.
+    HTTP/2 multiplexes the concurrent requests over a few connections, with
+    HPACK compressing the repeated headers.
+    """
+    transport = httpx.AsyncHTTPTransport(
+        http2=True,
+        retries=3,  # connect-fouten; HTTP-statussen worden in call_llm afgehandeld
+        limits=httpx.Limits(max_connections=8, max_keepalive_connections=8),
+    )
+    return httpx.AsyncClient(
+        # Content-Type zet httpx zelf (json= of multipart voor de batch-upload)
+        headers={"Authorization": f"Bearer {key}"},
+        transport=transport,
+        timeout=30,
+    )
+
+def build_payload(model: str, prompt: str) -> dict:
+    """Chat-completions request body for one employee prompt."""
+    return {
+        "model": model,
+        "messages": [
+            SYSTEM_MESSAGE,
+            {"role": "user", "content": prompt}
+        ],
+        "max_tokens": MAX_TOKENS,
+        "temperature": 0.3,
+        "stop": STOP_SEQUENCES,
+    }
+
+def retry_delay(resp, attempt: int) -> float:
+    """Seconds to wait: the server's Retry-After if given, else exponential backoff with jitter."""
+    retry_after = resp.headers.get("Retry-After") if resp is not None else None
+    if retry_after:
+        try:
+            return min(float(retry_after), MAX_RETRY_DELAY)
+        except ValueError:
+            pass  # HTTP-date variant; val terug op backoff
+    return min(2 ** attempt + random.random(), MAX_RETRY_DELAY)
+
+class StreamError(Exception):
+    """The server sent an error event inside a 200 stream; not retried."""
+
+class IncompleteStream(Exception):
+    """The stream ended without [DONE] or a finish_reason; retried like a network error."""
+
+async def read_stream(resp: httpx.Response):
+    """
+    Joins the content deltas of a streamed (SSE) chat-completions response and
+    returns (text, finish_reason). Raises StreamError on an in-stream error
+    event and IncompleteStream when the stream stops before the model finished.
+    """
+    parts = []
+    finished = False
+    finish_reason = None
+    async for line in resp.aiter_lines():
+        if not line.startswith("data: "):
+            continue
+        data = line[len("data: "):]
+        if data == "[DONE]":
+            finished = True
+            break
+        chunk = orjson.loads(data)
+        if chunk.get("error"):
+            raise StreamError(chunk["error"])
+        choices = chunk.get("choices") or []
+        if choices:
+            parts.append((choices[0].get("delta") or {}).get("content") or "")
+            if choices[0].get("finish_reason"):
+                finished = True
+                finish_reason = choices[0]["finish_reason"]
+    if not finished:
+        raise IncompleteStream(f"stream ended after {len(parts)} chunks without [DONE]")
+    return "".join(parts), finish_reason
+
+async def stream_with_retry(client: httpx.AsyncClient, limiter, payload: dict):
+    """
+    Sends payload as a streaming request and collects the answer text, retrying
+    network errors and 429/5xx responses up to MAX_RETRIES times.
+    Returns (response, text, finish_reason, None); text and finish_reason are
+    only set for a 200. Returns (response, None, None, error) for an error event
+    inside the stream and (None, None, None, error) if no complete response was
+    ever received. The last response is returned as-is when retries run out.
+    """
+    resp, err = None, None
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            async with limiter:
+                async with client.stream("POST", GROQ_URL, json={**payload, "stream": True}) as resp:
+                    if resp.status_code == 200:
+                        text, finish_reason = await read_stream(resp)
+                        return resp, text, finish_reason, None
+                    await resp.aread()  # foutbody voor de melding in call_llm
+        except StreamError as e:
+            return resp, None, None, e
+        except (httpx.TransportError, IncompleteStream, orjson.JSONDecodeError) as e:
+            # alleen netwerk-/streamfouten opnieuw proberen; bugs mogen hard falen
+            resp, err = None, e
+        else:
+            if resp.status_code not in RETRY_STATUSES:
+                return resp, None, None, None
+        if attempt < MAX_RETRIES:
+            await asyncio.sleep(retry_delay(resp, attempt))
+    return resp, None, None, err
+
+async def call_llm(client: httpx.AsyncClient, limiter, prompt: str, cache: ResponseCache = None):
     """
     Groq HTTP caller. Tries a short list of Groq models (returns first successful).
-    Uses env var GROQ_API. Returns (text, error).
-    """
-    import requests, json, os, time
-
-    key = os.getenv("GROQ_API") or os.getenv("GROQ_API_KEY")
-    if not key:
-        return None, "No GROQ_API found in env"
-
-    url = "https://api.groq.com/openai/v1/chat/completions"
-    headers = {"Authorization": f"Bearer {key}", "Content-Type": "application/json"}
-
-    # candidates (prefer explicit MODEL env, else try these)
-    candidates = []
-    env_model = os.getenv("MODEL")
-    if env_model:
-        candidates.append(env_model)
-    candidates += [
-        "groq/compound",
-        "groq/compound-mini",
-        "llama-3.1-8b-instant",
-        "llama-3.3-70b-versatile",
-        "openai/gpt-oss-20b"
-    ]
+    Auth headers come from the shared client (see make_client). Returns (text, error).
+    Cache hits skip the network and the rate limiter.
+    """
+
+    # explicit MODEL env: only that model; else the fallback list minus known-bad models
+    if MODEL:
+        candidates = [MODEL]
+    else:
+        candidates = [m for m in FALLBACK_MODELS if m not in BAD_MODELS]
 
     last_err = None
     for m in candidates:
-        payload = {
-            "model": m,
-            "messages": [
-                {"role": "system", "content": "Je bent een beknopte, praktische adviseur. Antwoord in het Nederlands."},
-                {"role": "user", "content": prompt}
-            ],
-            "max_tokens": 400,
-            "temperature": 0.3,
-        }
-        try:
-            resp = requests.post(url, json=payload, headers=headers, timeout=30)
-        except Exception as e:
-            last_err = f"Network error while trying model {m}: {e}"
+        payload = build_payload(m, prompt)
+        if cache is not None:
+            cached = cache.get(payload)
+            if cached is not None:
+                return cached, None
+        resp, text, finish_reason, err = await stream_with_retry(client, limiter, payload)
+        if resp is None:
+            last_err = f"No complete response from model {m}: {err}"
+            continue
+        if err is not None:
+            last_err = f"Model {m} sent a stream error: {err}"
             continue
 
         if resp.status_code == 200:
-            try:
-                j = resp.json()
-                # prefer structured OpenAI-like response
-                text = j["choices"][0]["message"]["content"]
-            except Exception:
-                # fallback: stringify JSON if structure differs
-                text = json.dumps(j, ensure_ascii=False)
-            return text.strip(), None
+            text = text.strip()
+            if not text:
+                last_err = f"Model {m} returned an empty answer"
+                continue
+            if finish_reason == "length":
+                # afgekapt op max_tokens (sectie C kan ontbreken): niet cachen, fout zodat hervatten opnieuw vraagt
+                last_err = f"Model {m} hit max_tokens ({MAX_TOKENS}); answer truncated"
+                continue
+            if cache is not None:
+                cache.set(payload, text)
+            return text, None
         else:
             last_err = f"Model {m} returned {resp.status_code}: {resp.text}"
-            # for auth errors stop early
+            if resp.status_code == 404:
+                BAD_MODELS.add(m)
+            # auth errors are key-level, not model-level: stop early, don't blacklist
             if resp.status_code in (401, 403):
                 return None, last_err
-            # otherwise try next model
-            time.sleep(0.2)
+            # otherwise try next model (transient errors were already retried)
 
+    if not candidates:
+        return None, "No model available: all fallback models returned 404"
     return None, last_err or "No model succeeded"
 
-def main():
-    print("Start generator — CSV:", CSV_PATH)
-    df = load_data(CSV_PATH)
-    if len(df) < N:
-        print(f"Waarschuwing: CSV kleiner ({len(df)}) dan N={N}. Gebruik alle rijen.")
-        sample_df = df.copy()
+async def get_with_retry(client: httpx.AsyncClient, url: str) -> httpx.Response:
+    """
+    GET with the same retry policy as the chat calls (network errors, 429/5xx,
+    Retry-After); raises once retries run out. Used for batch polling and
+    result files, where one hiccup must not abandon a submitted batch.
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        resp = None
+        try:
+            resp = await client.get(url)
+        except httpx.TransportError:
+            if attempt == MAX_RETRIES:
+                raise
+        else:
+            if resp.status_code not in RETRY_STATUSES or attempt == MAX_RETRIES:
+                resp.raise_for_status()
+                return resp
+        await asyncio.sleep(retry_delay(resp, attempt))
+
+async def submit_batch(client: httpx.AsyncClient, ids: list, prompts: list, model: str) -> dict:
+    """
+    Writes BATCH_INPUT_PATH, uploads it and creates the batch; returns the batch object.
+    Not retried: a retried create could submit (and bill) the same batch twice.
+    """
+    with open(BATCH_INPUT_PATH, "wb") as f:
+        for cid, prompt in zip(ids, prompts):
+            f.write(orjson.dumps({
+                "custom_id": cid,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": build_payload(model, prompt),
+            }, option=orjson.OPT_APPEND_NEWLINE))
+
+    resp = await client.post(
+        f"{GROQ_BASE_URL}/files",
+        data={"purpose": "batch"},
+        files={"file": (BATCH_INPUT_PATH.name, BATCH_INPUT_PATH.read_bytes(), "application/jsonl")},
+    )
+    resp.raise_for_status()
+    resp = await client.post(f"{GROQ_BASE_URL}/batches", json={
+        "input_file_id": resp.json()["id"],
+        "endpoint": "/v1/chat/completions",
+        "completion_window": "24h",
+    })
+    resp.raise_for_status()
+    batch = resp.json()
+    tqdm.write(f"Batch {batch['id']} ingediend ({len(prompts)} requests, model {model}); "
+               f"bij een onderbreking hervatten met --batch-id {batch['id']}")
+    return batch
+
+async def run_batch(client: httpx.AsyncClient, ids: list, prompts: list, model: str,
+                    cache: ResponseCache = None, batch_id: str = None):
+    """
+    Submits all prompts as one Batch API job (file upload + batch), polls until
+    it ends and returns ({custom_id: (text, error)}, final batch status).
+    With batch_id, skips submission and resumes polling that existing batch.
+    Successful answers are also stored in cache, same as live calls.
+    """
+    if batch_id:
+        batch = (await get_with_retry(client, f"{GROQ_BASE_URL}/batches/{batch_id}")).json()
+        tqdm.write(f"Batch {batch_id} hervat (status: {batch['status']})")
     else:
-        sample_df = df.sample(N, random_state=SEED).reset_index(drop=True)
+        batch = await submit_batch(client, ids, prompts, model)
 
-    OUT_PATH.parent.mkdir(parents=True, exist_ok=True)
-    out_f = open(OUT_PATH, "w", encoding="utf-8")
+    while batch["status"] not in ("completed", "failed", "expired", "cancelled"):
+        await asyncio.sleep(BATCH_POLL_INTERVAL)
+        batch = (await get_with_retry(client, f"{GROQ_BASE_URL}/batches/{batch['id']}")).json()
 
+    tqdm.write(f"Batch {batch['id']} klaar: {batch['status']}")
+    prompt_by_id = dict(zip(ids, prompts))
+    results = {}
+    for file_key in ("output_file_id", "error_file_id"):
+        file_id = batch.get(file_key)
+        if not file_id:
+            continue
+        resp = await get_with_retry(client, f"{GROQ_BASE_URL}/files/{file_id}/content")
+        for line in resp.content.splitlines():
+            if not line.strip():
+                continue
+            r = orjson.loads(line)
+            response = r.get("response") or {}
+            body = response.get("body") or {}
+            ok = response.get("status_code") == 200
+            text = (body["choices"][0]["message"]["content"] or "").strip() if ok else None
+            if ok and body["choices"][0].get("finish_reason") == "length":
+                results[r["custom_id"]] = (None, f"Batch answer hit max_tokens ({MAX_TOKENS}); answer truncated")
+            elif text:
+                results[r["custom_id"]] = (text, None)
+                if cache is not None and r["custom_id"] in prompt_by_id:
+                    cache.set(build_payload(model, prompt_by_id[r["custom_id"]]), text)
+            elif ok:
+                results[r["custom_id"]] = (None, "Batch request returned an empty answer")
+            else:
+                results[r["custom_id"]] = (None, f"Batch request returned {response.get('status_code')}: {r.get('error') or body}")
+    return results, batch["status"]
+
+async def bounded_call(sem, limiter, client, cache, prompt):
+    """Runs one LLM call within the concurrency and rate limits."""
+    async with sem:
+        return await call_llm(client, limiter, prompt, cache)
+
+async def write_results(queue: asyncio.Queue, out_f, idxs: list, ids: list, functies: list, fps: list):
+    """Single consumer that owns out_f; writes results in completion order."""
     errors = 0
-    for i in range(len(sample_df)):
-        row_series = sample_df.iloc[i]
-        rowd = row_series.to_dict()
-        prompt = build_prompt(rowd)
-        print(f"\n[{i+1}/{len(sample_df)}] Generating for medewerker_id={rowd.get('medewerker_id','?')} functie={rowd.get('functie','')}")
-        text, err = call_llm(prompt)
+    done = 0
+    pbar = None  # pas bij het eerste resultaat, anders staat de balk bij --batch uren op 0%
+    while True:
+        item = await queue.get()
+        if item is None:
+            if pbar is not None:
+                pbar.close()
+            return errors
+        if pbar is None:
+            pbar = tqdm(total=len(ids), unit="rij")
+        i, text, err = item
+        done += 1
+        pbar.update(1)
+        log.debug("medewerker_id=%s functie=%s", ids[i], functies[i])
         if err:
             errors += 1
-            print(f"  ERROR: {err}")
+            tqdm.write(f"ERROR medewerker_id={ids[i]}: {err}")
             out = {
-                "idx": i,
-                "medewerker_id": rowd.get("medewerker_id"),
-                "functie": rowd.get("functie"),
+                "idx": idxs[i],
+                "medewerker_id": ids[i],
+                "functie": functies[i],
+                "fingerprint": fps[i],
                 "answer": None,
                 "error": err
             }
         else:
             out = {
-                "idx": i,
-                "medewerker_id": rowd.get("medewerker_id"),
-                "functie": rowd.get("functie"),
+                "idx": idxs[i],
+                "medewerker_id": ids[i],
+                "functie": functies[i],
+                "fingerprint": fps[i],
                 "answer": text
             }
-            print("  OK — length:", len(text))
-        out_f.write(json.dumps(out, ensure_ascii=False) + "\n")
+            log.debug("  OK — length: %d", len(text))
+        out_f.write(orjson.dumps(out, option=orjson.OPT_APPEND_NEWLINE))
+        if done % FLUSH_EVERY == 0:
+            out_f.flush()
+
+def fingerprint(model: str, prompt: str) -> str:
+    """Hash of the full request (prompt, system prefix, settings) as stored per record."""
+    return ResponseCache.key(build_payload(model, prompt))
+
+def load_done(path: Path, expected: dict) -> set:
+    """
+    Returns the medewerker_ids in `expected` ({medewerker_id: fingerprint}) whose
+    newest answered record in path was made with the same fingerprint.
+    The file is append-only: per medewerker_id the newest record with an answer
+    is the result; older answers and error records stay as history, so a failed
+    re-run never loses earlier answers.
+    """
+    if not path.exists():
+        return set()
+    latest = {}
+    with open(path, "rb") as f:
+        for line in f:
+            try:
+                r = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                continue  # half-geschreven regel van een afgebroken run
+            if r.get("answer"):
+                latest[r.get("medewerker_id")] = r.get("fingerprint")
+    return {mid for mid, fp in expected.items() if mid in latest and latest[mid] == fp}
+
+async def main(batch: bool = False, fresh: bool = False, batch_id: str = None):
+    print("Start generator — CSV:", CSV_PATH)
+    batch = batch or bool(batch_id)
+    if not API_KEY:
+        raise SystemExit("No GROQ_API found in env")
+    df = load_data(CSV_PATH)
+    if len(df) < N:
+        print(f"Waarschuwing: CSV kleiner ({len(df)}) dan N={N}. Gebruik alle rijen.")
+        sample_df = df.copy()
+    else:
+        sample_df = df.sample(N, random_state=SEED).reset_index(drop=True)
+
+    prompts = build_prompts(sample_df)
+    # model in de fingerprint: bij de fallback-lijst telt de hele lijst
+    run_model = MODEL or (BATCH_MODEL if batch else ",".join(FALLBACK_MODELS))
+    fps = prompts.map(lambda p: fingerprint(run_model, p))
+
+    # hervatten: rijen met een antwoord van exact dezelfde request niet opnieuw opvragen;
+    # oudere antwoorden blijven staan tot er een nieuwer antwoord is bijgeschreven
+    OUT_PATH.parent.mkdir(parents=True, exist_ok=True)
+    if fresh:
+        OUT_PATH.unlink(missing_ok=True)
+    done_ids = load_done(OUT_PATH, dict(zip(sample_df["medewerker_id"], fps)))
+    if done_ids:
+        keep = ~sample_df["medewerker_id"].isin(done_ids)
+        sample_df, prompts, fps = sample_df[keep], prompts[keep], fps[keep]
+        print(f"Hervat: {len(done_ids)} rijen al klaar in {OUT_PATH}, {len(sample_df)} te gaan.")
+        if sample_df.empty:
+            return
+
+    # kolommen één keer naar lijsten; de loop indexeert alleen nog op positie
+    prompts = prompts.tolist()
+    fps = fps.tolist()
+    idxs = sample_df.index.tolist()  # positie in de steekproef, stabiel over hervattingen
+    ids = sample_df["medewerker_id"].tolist()
+    functies = sample_df["functie"].tolist()
+
+    # identieke prompts één keer versturen; het antwoord gaat naar alle rijen met die prompt
+    groups = {}
+    for i, prompt in enumerate(prompts):
+        groups.setdefault(prompt, []).append(i)
+    if len(groups) < len(prompts):
+        print(f"{len(prompts)} rijen, {len(groups)} unieke prompts")
+
+    if OUT_PATH.exists() and OUT_PATH.stat().st_size:
+        with open(OUT_PATH, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            partial_last_line = f.read(1) != b"\n"
+    else:
+        partial_last_line = False
+    out_f = open(OUT_PATH, "ab")
+    if partial_last_line:
+        out_f.write(b"\n")  # afgebroken laatste regel afsluiten
+
+    sem = asyncio.Semaphore(CONCURRENCY)
+    limiter = AsyncLimiter(QPM, 60)
+    cache = ResponseCache(CACHE_PATH)
+    queue = asyncio.Queue()
+    writer = asyncio.create_task(write_results(queue, out_f, idxs, ids, functies, fps))
+
+    async def run(client, prompt, rows):
+        text, err = await bounded_call(sem, limiter, client, cache, prompt)
+        for i in rows:
+            await queue.put((i, text, err))
+
+    try:
+        async with make_client(API_KEY) as client:
+            if batch:
+                model = MODEL or BATCH_MODEL
+                # gecachete prompts direct wegschrijven; alleen de misses gaan de batch in
+                misses = {}
+                for prompt, rows in groups.items():
+                    cached = cache.get(build_payload(model, prompt))
+                    if cached is not None:
+                        for i in rows:
+                            await queue.put((i, cached, None))
+                    else:
+                        misses[prompt] = rows
+                if misses:
+                    batch_ids = [ids[rows[0]] for rows in misses.values()]
+                    results, status = await run_batch(client, batch_ids, list(misses), model, cache, batch_id)
+                    for cid, rows in zip(batch_ids, misses.values()):
+                        text, err = results.get(cid, (None, f"No batch result (batch status: {status})"))
+                        for i in rows:
+                            await queue.put((i, text, err))
+            else:
+                tasks = [run(client, prompt, rows) for prompt, rows in groups.items()]
+                await asyncio.gather(*tasks)
+    finally:
+        await queue.put(None)
+        errors = await writer
+        cache.close()
         out_f.flush()
-        time.sleep(0.25)  # rate-limit friendly
+        os.fsync(out_f.fileno())
+        out_f.close()
 
-    out_f.close()
     print(f"Done. Wrote results to {OUT_PATH}. Errors: {errors}")
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Genereer antwoorden per medewerker via de Groq API.")
+    parser.add_argument("--batch", action="store_true",
+                        help="dien alle prompts in als één Batch API-job (goedkoper, tot 24u doorlooptijd)")
+    parser.add_argument("--batch-id",
+                        help="hervat het pollen van een eerder ingediende batch (impliceert --batch; "
+                             "gebruik dezelfde MODEL als bij het indienen)")
+    parser.add_argument("--fresh", action="store_true",
+                        help="begin opnieuw: verwijder OUT_PATH; standaard wordt er aan toegevoegd "
+                             "en telt per medewerker het nieuwste antwoord")
+    parser.add_argument("--verbose", action="store_true", help="log per rij (medewerker, lengte antwoord)")
+    args = parser.parse_args()
+    if args.verbose:
+        log.setLevel(logging.DEBUG)
+        log.addHandler(logging.StreamHandler())
+    with logging_redirect_tqdm(loggers=[log]):
+        asyncio.run(main(batch=args.batch, fresh=args.fresh, batch_id=args.batch_id))